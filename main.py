@@ -1,16 +1,19 @@
-import json
+import asyncio
 import os
+import re
+import threading
+import ahocorasick
+import orjson
 import hashlib
 import hmac
 import base64
-import tempfile
-import difflib
 import logging
 from datetime import datetime
-from fastapi import FastAPI, Request, Header, HTTPException
+from fastapi import FastAPI, Request, Header, HTTPException, BackgroundTasks
 from fastapi.responses import JSONResponse
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from rapidfuzz import fuzz, process
 
 # === CONFIG ===
 TRIGGER_TAG = "pc"
@@ -33,8 +36,8 @@ logging.basicConfig(
 # === LOAD CITY ALIASES AND LIST ===
 def load_alias_map(filepath):
     try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(filepath, "rb") as f:
+            return orjson.loads(f.read())
     except Exception as e:
         logging.warning(f"⚠️ Failed to load alias map: {e}")
         return {}
@@ -48,22 +51,53 @@ def load_cities(filepath):
         return []
 
 CITY_ALIASES = load_alias_map(CITY_ALIAS_PATH)
-VALID_CITIES = load_cities(CITY_LIST_PATH)
+VALID_CITIES = tuple(load_cities(CITY_LIST_PATH))
+VALID_CITY_SET = frozenset(VALID_CITIES)
+
+def build_city_automaton(cities):
+    if not cities:
+        return None
+    automaton = ahocorasick.Automaton()
+    for position, city in enumerate(cities):
+        # add_word overwrites, so keep a duplicated city at its first position
+        if city not in automaton:
+            automaton.add_word(city, (position, city))
+    automaton.make_automaton()
+    return automaton
+
+# Finds every known city inside an address in one pass over the address
+CITY_AUTOMATON = build_city_automaton(VALID_CITIES)
 
 # === GOOGLE SHEETS AUTH ===
 encoded_credentials = os.getenv("GOOGLE_CREDENTIALS_BASE64")
 if not encoded_credentials:
     raise RuntimeError("Missing GOOGLE_CREDENTIALS_BASE64 env variable")
 
-with tempfile.NamedTemporaryFile(delete=False, suffix=".json") as temp_cred_file:
-    temp_cred_file.write(base64.b64decode(encoded_credentials))
-    temp_cred_file_path = temp_cred_file.name
-
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
-credentials = service_account.Credentials.from_service_account_file(
-    temp_cred_file_path, scopes=SCOPES
+credentials_info = orjson.loads(base64.b64decode(encoded_credentials))
+credentials = service_account.Credentials.from_service_account_info(
+    credentials_info, scopes=SCOPES
 )
-sheets_service = build("sheets", "v4", credentials=credentials)
+
+# googleapiclient services share one httplib2.Http and aren't thread-safe,
+# so every worker thread gets its own client
+_thread_local = threading.local()
+
+def get_sheets_service():
+    service = getattr(_thread_local, "sheets_service", None)
+    if service is None:
+        service = build("sheets", "v4", credentials=credentials, cache_discovery=False)
+        _thread_local.sheets_service = service
+    return service
+
+# Caps in-flight webhooks hitting Sheets to stay well under the per-user quota
+SHEETS_CONCURRENCY = asyncio.Semaphore(4)
+
+# Striped locks so concurrent webhooks for the same order can't both export it
+ORDER_LOCKS = [threading.Lock() for _ in range(64)]
+
+def order_lock(spreadsheet_id, order_id):
+    return ORDER_LOCKS[hash((spreadsheet_id, order_id)) % len(ORDER_LOCKS)]
 
 # === FASTAPI APP ===
 app = FastAPI()
@@ -95,44 +129,78 @@ def get_corrected_city(input_city, address_hint=""):
     if city_clean in CITY_ALIASES:
         corrected = CITY_ALIASES[city_clean]
         return corrected, f"✅ Matched alias: '{input_city}' → '{corrected}'"
-    matches = difflib.get_close_matches(city_clean, VALID_CITIES, n=1, cutoff=0.85)
-    if matches:
-        corrected = matches[0].title()
+    if city_clean in VALID_CITY_SET:
+        corrected = city_clean.title()
         return corrected, f"✅ Fuzzy matched: '{input_city}' → '{corrected}'"
-    for city in VALID_CITIES:
-        if city in address_hint.lower():
+    match = process.extractOne(city_clean, VALID_CITIES, scorer=fuzz.ratio, score_cutoff=85)
+    if match:
+        corrected = match[0].title()
+        return corrected, f"✅ Fuzzy matched: '{input_city}' → '{corrected}'"
+    if CITY_AUTOMATON is not None:
+        # Earliest city in the list wins, as with a linear scan
+        found = min((value for _, value in CITY_AUTOMATON.iter(address_hint.lower())), default=None)
+        if found:
+            city = found[1]
             return city.title(), f"✅ Guessed from address: '{input_city}' → '{city.title()}'"
     return input_city, f"🛑 Could not match: '{input_city}'"
 
-def apply_green_background(sheet_id, row_index):
-    body = {
-        "requests": [
-            {
-                "repeatCell": {
-                    "range": {
-                        "sheetId": 0,
-                        "startRowIndex": row_index - 1,
-                        "endRowIndex": row_index,
-                        "startColumnIndex": 0,
-                        "endColumnIndex": 12
-                    },
-                    "cell": {
-                        "userEnteredFormat": {
-                            "backgroundColor": {
-                                "red": 0.8,
-                                "green": 1.0,
-                                "blue": 0.8
-                            }
-                        }
-                    },
-                    "fields": "userEnteredFormat.backgroundColor"
+# Row numbers come from Sheet1 reads, so batch requests must target Sheet1's own
+# sheetId rather than assuming it is the first tab
+SHEET1_IDS = {}
+
+def get_sheet1_id(spreadsheet_id):
+    sheet1_id = SHEET1_IDS.get(spreadsheet_id)
+    if sheet1_id is None:
+        sheets = get_sheets_service().spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            fields="sheets.properties(sheetId,title)"
+        ).execute().get("sheets", [])
+        sheet1_id = next(
+            sheet["properties"]["sheetId"] for sheet in sheets if sheet["properties"].get("title") == "Sheet1"
+        )
+        SHEET1_IDS[spreadsheet_id] = sheet1_id
+    return sheet1_id
+
+def green_background_request(sheet1_id, row_index):
+    return {
+        "repeatCell": {
+            "range": {
+                "sheetId": sheet1_id,
+                "startRowIndex": row_index - 1,
+                "endRowIndex": row_index,
+                "startColumnIndex": 0,
+                "endColumnIndex": 12
+            },
+            "cell": {
+                "userEnteredFormat": {
+                    "backgroundColor": {
+                        "red": 0.8,
+                        "green": 1.0,
+                        "blue": 0.8
+                    }
                 }
-            }
-        ]
+            },
+            "fields": "userEnteredFormat.backgroundColor"
+        }
+    }
+
+def status_cell_request(sheet1_id, row_index, status):
+    return {
+        "updateCells": {
+            "start": {
+                "sheetId": sheet1_id,
+                "rowIndex": row_index - 1,
+                "columnIndex": 11
+            },
+            "rows": [{"values": [{"userEnteredValue": {"stringValue": status}}]}],
+            "fields": "userEnteredValue"
+        }
     }
 
+def apply_green_background(sheet_id, row_index):
     try:
-        sheets_service.spreadsheets().batchUpdate(
+        body = {"requests": [green_background_request(get_sheet1_id(sheet_id), row_index)]}
+        get_sheets_service().spreadsheets().batchUpdate(
             spreadsheetId=sheet_id,
             body=body
         ).execute()
@@ -140,10 +208,92 @@ def apply_green_background(sheet_id, row_index):
     except Exception as e:
         logging.error(f"❌ Failed to color row {row_index}: {e}")
 
+def mark_order_status(sheet_id, row_index, status):
+    # Status write and fulfilled coloring go out as one batchUpdate round trip
+    try:
+        sheet1_id = get_sheet1_id(sheet_id)
+        reqs = [status_cell_request(sheet1_id, row_index, status)]
+        if status == "FULFILLED":
+            reqs.append(green_background_request(sheet1_id, row_index))
+        get_sheets_service().spreadsheets().batchUpdate(
+            spreadsheetId=sheet_id,
+            body={"requests": reqs}
+        ).execute()
+        return
+    except Exception as e:
+        logging.warning(f"⚠️ Batched status update failed for row {row_index}, retrying per request: {e}")
+
+    get_sheets_service().spreadsheets().values().update(
+        spreadsheetId=sheet_id,
+        range=f"Sheet1!L{row_index}",
+        valueInputOption="USER_ENTERED",
+        body={"values": [[status]]}
+    ).execute()
+    if status == "FULFILLED":
+        apply_green_background(sheet_id, row_index)
+
+# === ORDER ROW INDEX ===
+# spreadsheet_id -> {order_id: row_index}, so webhooks don't re-read the whole sheet
+ORDER_INDEX = {}
+# Held around every reload and insert, so a reload read before another worker's append
+# can't replace the index and drop that worker's new row
+ORDER_INDEX_LOCKS = {spreadsheet_id: threading.RLock() for spreadsheet_id in SHOP_DOMAIN_TO_SHEET.values()}
+
+def load_order_index(spreadsheet_id):
+    with ORDER_INDEX_LOCKS[spreadsheet_id]:
+        rows = get_sheets_service().spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id,
+            range="Sheet1!B:B"
+        ).execute().get("values", [])
+        index = {}
+        for idx, row in enumerate(rows[1:], start=2):  # Start from row 2
+            if row:
+                index.setdefault(row[0], idx)
+        ORDER_INDEX[spreadsheet_id] = index
+    logging.info(f"📇 Indexed {len(index)} orders for sheet {spreadsheet_id}")
+    return index
+
+def get_order_index(spreadsheet_id):
+    index = ORDER_INDEX.get(spreadsheet_id)
+    if index is None:
+        with ORDER_INDEX_LOCKS[spreadsheet_id]:
+            index = ORDER_INDEX.get(spreadsheet_id)
+            if index is None:
+                index = load_order_index(spreadsheet_id)
+    return index
+
+# Returns (row_index, row) for order_id, or (None, None) if it isn't in the sheet
+def get_order_row(spreadsheet_id, order_id):
+    index = get_order_index(spreadsheet_id)
+    for _ in range(2):
+        idx = index.get(order_id)
+        if idx is None:
+            return None, None
+        values = get_sheets_service().spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id,
+            range=f"Sheet1!A{idx}:L{idx}"
+        ).execute().get("values", [])
+        row = values[0] if values else []
+        if len(row) > 1 and row[1] == order_id:
+            return idx, row
+        # Rows were moved or deleted by hand since the index was built
+        index = load_order_index(spreadsheet_id)
+    return None, None
+
+def remember_appended_row(spreadsheet_id, order_id, append_response):
+    updated_range = append_response.get("updates", {}).get("updatedRange", "")
+    match = re.search(r"![A-Z]+(\d+)", updated_range)
+    with ORDER_INDEX_LOCKS[spreadsheet_id]:
+        if match:
+            get_order_index(spreadsheet_id)[order_id] = int(match.group(1))
+        else:
+            ORDER_INDEX.pop(spreadsheet_id, None)
+
 # === WEBHOOK ENDPOINT ===
 @app.post("/webhook/orders-updated")
 async def webhook_orders_updated(
     request: Request,
+    background_tasks: BackgroundTasks,
     x_shopify_shop_domain: str = Header(None),
     x_shopify_hmac_sha256: str = Header(None)
 ):
@@ -152,69 +302,66 @@ async def webhook_orders_updated(
 
     spreadsheet_id = SHOP_DOMAIN_TO_SHEET[x_shopify_shop_domain]
     body = await request.body()
-    order = json.loads(body)
+    order = orjson.loads(body)
 
     # Uncomment in production
     # if not verify_shopify_webhook(body, x_shopify_hmac_sha256):
     #     raise HTTPException(status_code=401, detail="Invalid HMAC")
 
+    # Acknowledge right away so Shopify's 5s timeout never triggers a retry;
+    # the Sheets work runs after the response is sent
+    background_tasks.add_task(run_order_update, spreadsheet_id, order)
+    return JSONResponse(content={"queued": True})
+
+async def run_order_update(spreadsheet_id, order):
+    try:
+        # Sheets calls block on httplib2, so run them off the event loop
+        async with SHEETS_CONCURRENCY:
+            await asyncio.to_thread(process_order_update, spreadsheet_id, order)
+    except Exception as e:
+        logging.error(f"❌ Failed to process order {order.get('name', '')}: {e}")
+
+def process_order_update(spreadsheet_id, order):
+    order_id = order.get("name", "")
+    with order_lock(spreadsheet_id, order_id):
+        sync_order_to_sheet(spreadsheet_id, order)
+
+def sync_order_to_sheet(spreadsheet_id, order):
     order_id = order.get("name", "")
     tags_str = order.get("tags", "")
     current_tags = [t.strip().lower() for t in tags_str.split(",")]
 
     # === MARK EXISTING ROWS BASED ON STATUS OR TAG "ch" ===
     try:
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id,
-            range="Sheet1!A:K"
-        ).execute()
-        rows = result.get("values", [])
-        for idx, row in enumerate(rows[1:], start=2):  # Start from row 2
-            if len(row) > 1 and row[1] == order_id:
-                existing_status = row[11] if len(row) > 11 else ""
-                status = ""
-                if order.get("cancelled_at"):
-                    status = "CANCELLED"
-                elif order.get("fulfillment_status") == "fulfilled":
-                    status = "FULFILLED"
-                elif "ch" in current_tags:
-                    status = "CH"
-
-                if status and existing_status.strip().upper() != status:
-                    update_range = f"Sheet1!L{idx}"
-                    sheets_service.spreadsheets().values().update(
-                        spreadsheetId=spreadsheet_id,
-                        range=update_range,
-                        valueInputOption="USER_ENTERED",
-                        body={"values": [[status]]}
-                    ).execute()
-
-                    if status == "FULFILLED":
-                        apply_green_background(spreadsheet_id, idx)
-
-                    logging.info(f"🎨 Updated row {order_id} → {status}")
-                break
+        idx, row = get_order_row(spreadsheet_id, order_id)
+        if idx:
+            existing_status = row[11] if len(row) > 11 else ""
+            status = ""
+            if order.get("cancelled_at"):
+                status = "CANCELLED"
+            elif order.get("fulfillment_status") == "fulfilled":
+                status = "FULFILLED"
+            elif "ch" in current_tags:
+                status = "CH"
+
+            if status and existing_status.strip().upper() != status:
+                mark_order_status(spreadsheet_id, idx, status)
+                logging.info(f"🎨 Updated row {order_id} → {status}")
     except Exception as e:
         logging.error(f"❌ Failed to mark status for {order_id}: {e}")
 
     # === EXPORT ONLY IF PC TAG IS NEW + ORDER IS OPEN/UNFULFILLED ===
     if TRIGGER_TAG not in current_tags:
         logging.info(f"🚫 Skipping {order_id} — no 'pc' tag")
-        return JSONResponse(content={"skipped": True})
+        return
 
-    existing_orders = sheets_service.spreadsheets().values().get(
-        spreadsheetId=spreadsheet_id,
-        range="Sheet1!A:K"
-    ).execute().get("values", [])
-    order_ids = [r[1] for r in existing_orders[1:] if len(r) > 1]
-
-    if order_id in order_ids:
+    if order_id in get_order_index(spreadsheet_id):
         logging.info(f"⚠️ Already exported {order_id} — skipping")
-        return JSONResponse(content={"skipped": True})
+        return
 
     if order.get("fulfillment_status") == "fulfilled" or order.get("cancelled_at") or order.get("closed_at"):
         logging.info(f"🚫 Order {order_id} is fulfilled/cancelled/closed — skipping")
-        return JSONResponse(content={"skipped": True})
+        return
 
     # === EXPORT NEW ORDER ===
     try:
@@ -248,19 +395,18 @@ async def webhook_orders_updated(
         ]
         row = (row + [""] * 12)[:12]
 
-        sheets_service.spreadsheets().values().append(
+        append_response = get_sheets_service().spreadsheets().values().append(
             spreadsheetId=spreadsheet_id,
             range="Sheet1!A1",
             valueInputOption="USER_ENTERED",
             insertDataOption="INSERT_ROWS",
             body={"values": [row]}
         ).execute()
+        remember_appended_row(spreadsheet_id, order_id, append_response)
         logging.info(f"✅ Exported order {order_id}")
     except Exception as e:
         logging.error(f"❌ Error exporting order {order_id}: {e}")
 
-    return JSONResponse(content={"success": True})
-
 # === HEALTH CHECK ===
 @app.get("/ping")
 async def ping():
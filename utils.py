@@ -1,12 +1,40 @@
 import os
 import re
+import math
+import atexit
+import logging
+import logging.handlers
+import queue
 import hashlib
+import sqlite3
+import threading
+from urllib.parse import quote
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image, ImageDraw, ImageFont
 import boto3
-from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 from io import BytesIO
 
+# === LOGGER ===
+# Worker threads only enqueue records; a single listener thread writes them to stderr,
+# so the pools never contend on the stream lock
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 # Load environment variables
 API_KEY = os.getenv("SHOPIFY_API_KEY")
 PASSWORD = os.getenv("SHOPIFY_PASSWORD")
@@ -17,102 +45,349 @@ R2_SECRET_KEY = os.getenv("R2_SECRET_KEY")
 R2_BUCKET = os.getenv("R2_BUCKET")
 R2_ENDPOINT = os.getenv("R2_ENDPOINT")  # e.g. https://<account>.r2.cloudflarestorage.com
 
+# Both legs are network-bound, so these can go well past the CPU count
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", 16))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 16))
+# Each queued upload holds its downloaded image in memory, so cap how many can wait
+MAX_PENDING_UPLOADS = 64
+
 size_pattern = re.compile(r'\b(?:XS|S|M|L|XL|XXL|XXXL)\b|\d+')
+unsafe_path_chars = re.compile(r'[<>:"/\\|?*]')
+SIZE_TOKENS = frozenset({"XS", "S", "M", "L", "XL", "XXL", "XXXL"})
+
+# Price label font, loaded once rather than per image
+try:
+    PRICE_FONT = ImageFont.truetype("arial.ttf", 40)
+except IOError:
+    PRICE_FONT = ImageFont.load_default()
+
+# Shared HTTP session so image downloads reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=max(32, DOWNLOAD_WORKERS),
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+# Change detection only needs a fingerprint, not a security hash. BLAKE3 uses SIMD when
+# installed; stdlib BLAKE2b is the fallback. Digests carry the algorithm tag so switching
+# between them invalidates old index rows instead of comparing unlike hashes.
+try:
+    from blake3 import blake3 as new_hasher
+    DIGEST_TAG = "b3"
+except ImportError:
+    def new_hasher():
+        return hashlib.blake2b(digest_size=16)
+    DIGEST_TAG = "b2"
+
+def tagged_digest(hasher):
+    return f"{DIGEST_TAG}:{hasher.hexdigest()}"
+
+# Fingerprint (source digest + price) of what was last uploaded to each R2 key,
+# so unchanged variants are skipped without keeping image files on disk
+HASH_DB_PATH = os.getenv("HASH_DB_PATH", ".irrakids_hash.db")
+hash_db = sqlite3.connect(HASH_DB_PATH, check_same_thread=False)
+hash_db.execute("PRAGMA journal_mode=WAL")
+hash_db.execute("PRAGMA synchronous=NORMAL")
+hash_db.execute(
+    "CREATE TABLE IF NOT EXISTS uploaded_images (key TEXT PRIMARY KEY, digest TEXT, price TEXT)"
+)
+# Last ETag the CDN returned per image URL, so unchanged images revalidate with a bodiless 304
+hash_db.execute(
+    "CREATE TABLE IF NOT EXISTS image_etags (url TEXT PRIMARY KEY, etag TEXT, digest TEXT)"
+)
+hash_db_lock = threading.Lock()
 
 # Initialize S3 (R2)
 s3 = boto3.client(
     's3',
     endpoint_url=R2_ENDPOINT,
     aws_access_key_id=R2_ACCESS_KEY,
-    aws_secret_access_key=R2_SECRET_KEY
+    aws_secret_access_key=R2_SECRET_KEY,
+    # One pooled connection per worker (downloaders HEAD objects, uploaders PUT them);
+    # adaptive retries back off on 429/SlowDown
+    config=Config(
+        max_pool_connections=UPLOAD_WORKERS + DOWNLOAD_WORKERS,
+        retries={"max_attempts": 5, "mode": "adaptive"}
+    )
 )
 
-def upload_image_to_r2(image: Image.Image, key: str):
+# Stamped images are a few hundred KB, well under the 5 MiB minimum part size for
+# multipart, so each goes out as one PUT. Concurrency already comes from the upload pool,
+# so don't spin up transfer threads per call.
+R2_TRANSFER = TransferConfig(multipart_threshold=8 * 1024 * 1024, use_threads=False)
+
+def encode_jpeg(image: Image.Image) -> bytes:
     buffer = BytesIO()
-    image.save(buffer, format="JPEG")
-    buffer.seek(0)
+    # Baseline 4:2:0 JPEG keeps libjpeg-turbo on its fast path
+    image.save(buffer, format="JPEG", quality=82, optimize=False, progressive=False, subsampling=2)
+    return buffer.getvalue()
 
+def upload_image_to_r2(jpeg_data: bytes, key: str, metadata=None):
+    extra_args = {'ContentType': 'image/jpeg', 'ACL': 'public-read'}
+    if metadata:
+        extra_args['Metadata'] = metadata
     try:
         s3.upload_fileobj(
-            buffer,
+            BytesIO(jpeg_data),
             R2_BUCKET,
             key,
-            ExtraArgs={'ContentType': 'image/jpeg', 'ACL': 'public-read'}
+            ExtraArgs=extra_args,
+            Config=R2_TRANSFER
         )
         return f"{R2_ENDPOINT}/{R2_BUCKET}/{key}"
-    except ClientError as e:
-        print(f"❌ Upload failed: {e}")
+    except (ClientError, BotoCoreError) as e:
+        logger.error(f"❌ Upload failed: {e}")
         return None
 
+# Exact size tokens and plain numbers skip the regex; it only runs on free-form values
+def is_size_value(value):
+    return value.strip() in SIZE_TOKENS or value.isdecimal() or size_pattern.search(value) is not None
+
+@lru_cache(maxsize=4096)
 def sanitize_directory_name(name):
-    return re.sub(r'[<>:"/\\|?*]', '_', name)
+    return unsafe_path_chars.sub('_', name)
+
+# Option values repeat across thousands of variants ("S", "6", ...), so memoize the pick
+@lru_cache(maxsize=4096)
+def size_from_options(option1, option2, option3):
+    for value in (option1, option2, option3):
+        if value and is_size_value(value):  # Shopify sends null for unused options
+            return sanitize_directory_name(value)
+    return "default"
 
-def create_directory(path):
-    if not os.path.exists(path):
-        os.makedirs(path)
+def r2_key(size_option, folder_name, variant_id):
+    return f"{size_option}/{folder_name}/{variant_id}.jpg"
 
-def add_price_to_image(image_path, price, size_option, folder_name, variant_id):
+# Distinct prices are few, so each label is only measured once. Advance width and
+# line metrics come straight from the font tables without laying out glyph boxes.
+@lru_cache(maxsize=256)
+def measure_price_label(int_price):
+    price_text = f"{int_price} DH"
+    if hasattr(PRICE_FONT, "getmetrics"):
+        ascent, descent = PRICE_FONT.getmetrics()
+        return price_text, math.ceil(PRICE_FONT.getlength(price_text)), ascent + descent
+    # Bitmap fallback font has no line metrics
+    bbox = PRICE_FONT.getbbox(price_text)
+    return price_text, bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+# The blue box with its white price, rendered once per price and pasted as one blit
+@lru_cache(maxsize=512)
+def price_label_tile(int_price):
+    price_text, text_width, text_height = measure_price_label(int_price)
+    tile = Image.new("RGB", (text_width + 21, text_height + 21), "#004AAD")
+    ImageDraw.Draw(tile).text((10, 10), price_text, font=PRICE_FONT, fill="white")
+    return tile
+
+# Stamps the image once and uploads the same JPEG under every gender folder;
+# returns the keys that were uploaded
+def add_price_to_image(image_data, price, size_option, folder_names, variant_id, metadata=None):
+    uploaded = []
     try:
-        img = Image.open(image_path).convert("RGB")
-        draw = ImageDraw.Draw(img)
-        try:
-            font = ImageFont.truetype("arial.ttf", 40)
-        except IOError:
-            font = ImageFont.load_default()
+        img = Image.open(BytesIO(image_data))
+        if img.mode != "RGB":  # convert() copies the frame even when the mode already matches
+            img = img.convert("RGB")
 
-        price_text = f"{int(float(price))} DH"
-        bbox = draw.textbbox((0, 0), price_text, font=font)
-        text_width, text_height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        int_price = int(float(price))
+        _, text_width, text_height = measure_price_label(int_price)
         x, y = img.width - text_width - 20, img.height - text_height - 20
-        draw.rectangle([x - 10, y - 10, x + text_width + 10, y + text_height + 10], fill="#004AAD")
-        draw.text((x, y), price_text, font=font, fill="white")
+        img.paste(price_label_tile(int_price), (x - 10, y - 10))
 
-        key = f"{size_option}/{folder_name}/{variant_id}.jpg"
-        url = upload_image_to_r2(img, key)
-        print(f"✅ Uploaded to {url}")
-
-        if os.path.exists(image_path):
-            os.remove(image_path)
+        jpeg_data = encode_jpeg(img)
     except Exception as e:
-        print(f"⚠️ Error processing image {image_path}: {e}")
+        logger.warning(f"⚠️ Error processing image for variant {variant_id}: {e}")
+        return uploaded
+
+    # Each folder gets its own try so one failed PUT doesn't skip the other gender's copy
+    # (upload_fileobj wraps PUT errors in S3UploadFailedError, which isn't a ClientError)
+    for folder_name in folder_names:
+        key = r2_key(size_option, folder_name, variant_id)
+        try:
+            url = upload_image_to_r2(jpeg_data, key, metadata)
+        except Exception as e:
+            logger.warning(f"⚠️ Error uploading {key}: {e}")
+            continue
+        if url:
+            logger.info(f"✅ Uploaded to {url}")
+            uploaded.append(key)
+    return uploaded
+
+def is_image_new(key, digest, price):
+    with hash_db_lock:
+        row = hash_db.execute(
+            "SELECT digest, price FROM uploaded_images WHERE key = ?", (key,)
+        ).fetchone()
+    return row != (digest, str(price))
+
+def remember_upload(key, digest, price):
+    with hash_db_lock:
+        hash_db.execute(
+            "INSERT OR REPLACE INTO uploaded_images (key, digest, price) VALUES (?, ?, ?)",
+            (key, digest, str(price))
+        )
 
-def download_image_if_new(image_url, image_path):
+def forget_uploads(keys):
+    with hash_db_lock:
+        hash_db.executemany("DELETE FROM uploaded_images WHERE key = ?", [(key,) for key in keys])
+
+# Removes out-of-stock variants' images from R2, up to 1000 keys per DeleteObjects call.
+# Keys are sent whether or not this index saw them uploaded, since a cold index
+# doesn't know about objects from earlier deploys; deleting a missing key is a no-op.
+def delete_stale_images(keys):
+    for start in range(0, len(keys), 1000):
+        batch = keys[start:start + 1000]
+        try:
+            response = s3.delete_objects(
+                Bucket=R2_BUCKET,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+            )
+        except (ClientError, BotoCoreError) as e:
+            logger.error(f"❌ Failed to delete stale images: {e}")
+            continue
+        failed = {error["Key"] for error in response.get("Errors", [])}
+        for key in failed:
+            logger.warning(f"⚠️ Could not delete stale image {key}")
+        forget_uploads([key for key in batch if key not in failed])
+        logger.info(f"🗑️ Requested deletion of {len(batch) - len(failed)} out-of-stock image keys")
+
+def has_upload_record(key):
+    with hash_db_lock:
+        row = hash_db.execute("SELECT 1 FROM uploaded_images WHERE key = ?", (key,)).fetchone()
+    return row is not None
+
+# S3 user metadata must be ASCII, and Shopify image URLs can contain accented file names
+def metadata_url(image_url):
+    return quote(image_url, safe=":/?&=%")
+
+# Each R2 object carries the source URL, ETag, digest and price it was stamped from, so
+# a cold local index (fresh deploy) is rebuilt with a HEAD instead of a re-download
+def restore_from_r2(key, image_url, price):
     try:
-        response = requests.get(image_url)
-        if response.status_code != 200:
-            print(f"❌ Failed to fetch image: {image_url}")
-            return False
-        image_data = response.content
-        new_hash = hashlib.md5(image_data).hexdigest()
-        if os.path.exists(image_path):
-            with open(image_path, "rb") as f:
-                existing_hash = hashlib.md5(f.read()).hexdigest()
-            if existing_hash == new_hash:
-                return False
-        with open(image_path, "wb") as f:
-            f.write(image_data)
-        return True
-    except Exception as e:
-        print(f"⚠️ Error downloading image: {e}")
+        head = s3.head_object(Bucket=R2_BUCKET, Key=key)
+    except (ClientError, BotoCoreError):  # missing object or unreachable R2: just download
+        return False
+    metadata = head.get("Metadata", {})
+    if metadata.get("source-url") != metadata_url(image_url) or metadata.get("price") != str(price):
         return False
+    digest = metadata.get("source-digest")
+    remember_upload(key, digest, price)
+    remember_etag(image_url, metadata.get("source-etag"), digest)
+    return True
+
+def cached_etag(image_url):
+    with hash_db_lock:
+        row = hash_db.execute(
+            "SELECT etag, digest FROM image_etags WHERE url = ?", (image_url,)
+        ).fetchone()
+    return row or (None, None)
+
+def remember_etag(image_url, etag, digest):
+    if not etag:
+        return
+    with hash_db_lock:
+        hash_db.execute(
+            "INSERT OR REPLACE INTO image_etags (url, etag, digest) VALUES (?, ?, ?)",
+            (image_url, etag, digest)
+        )
+
+# Returns (image_data, digest, etag); image_data is None if the fetch failed or the CDN
+# answered 304 Not Modified to the given etag
+def download_image(image_url, etag=None):
+    headers = {"If-None-Match": etag} if etag else None
+    try:
+        with SESSION.get(image_url, headers=headers, timeout=(3, 10), stream=True) as response:
+            if response.status_code == 304:
+                return None, None, etag
+            if response.status_code != 200:
+                logger.error(f"❌ Failed to fetch image: {image_url}")
+                return None, None, None
+            h = new_hasher()
+            buffer = BytesIO()
+            for chunk in response.iter_content(65536):
+                h.update(chunk)
+                buffer.write(chunk)
+            digest = tagged_digest(h)
+            new_etag = response.headers.get("ETag")
+            remember_etag(image_url, new_etag, digest)
+            # getvalue() hands back BytesIO's own buffer, so the body isn't copied again
+            return buffer.getvalue(), digest, new_etag
+    except Exception as e:
+        logger.warning(f"⚠️ Error downloading image: {e}")
+        return None, None, None
 
 def fetch_all_products():
     products = []
+    # Cursor pagination: each page's Link header carries the page_info URL of the next one
+    url = f"{STORE_URL}/admin/api/2024-01/products.json?limit=250"
     page = 1
-    while True:
-        url = f"{STORE_URL}/admin/api/2023-04/products.json?limit=250&page={page}"
-        response = requests.get(url, auth=(API_KEY, PASSWORD))
-        if response.status_code != 200:
-            print(f"❌ Failed to fetch products on page {page}")
+    while url:
+        try:
+            response = SESSION.get(url, auth=(API_KEY, PASSWORD), timeout=(3, 30))
+        except requests.RequestException as e:  # timeouts, or retries exhausted on 429/5xx
+            logger.error(f"❌ Failed to fetch products on page {page}: {e}")
             break
-        batch = response.json().get("products", [])
-        if not batch:
+        if response.status_code != 200:
+            logger.error(f"❌ Failed to fetch products on page {page}")
             break
-        products.extend(batch)
+        products.extend(response.json().get("products", []))
+        url = response.links.get("next", {}).get("url")
         page += 1
     return products
 
+pending_uploads = threading.BoundedSemaphore(MAX_PENDING_UPLOADS)
+
+# Only record the fingerprint once the upload has landed, so failures are retried next run
+def stamp_and_upload(image_data, source, price, size_option, folder_names, variant_id):
+    image_url, etag, digest = source
+    metadata = {
+        "source-url": metadata_url(image_url),
+        "source-etag": etag or "",
+        "source-digest": digest,
+        "price": str(price)
+    }
+    for key in add_price_to_image(image_data, price, size_option, folder_names, variant_id, metadata):
+        remember_upload(key, digest, price)
+
+def submit_upload(upload_pool, *args):
+    pending_uploads.acquire()
+    future = upload_pool.submit(stamp_and_upload, *args)
+    future.add_done_callback(lambda _: pending_uploads.release())
+    return future
+
+# Download image_url once and re-stamp every variant/folder whose image or price changed
+def sync_image(image_url, targets, upload_pool):
+    try:
+        for price, size_option, folder_name, variant_id in targets:
+            key = r2_key(size_option, folder_name, variant_id)
+            if not has_upload_record(key):
+                restore_from_r2(key, image_url, price)
+
+        etag, digest = cached_etag(image_url)
+        # Only revalidate when every target is already current for the cached image;
+        # otherwise the body is needed to re-stamp
+        if etag and any(
+            is_image_new(r2_key(size_option, folder_name, variant_id), digest, price)
+            for price, size_option, folder_name, variant_id in targets
+        ):
+            etag = None
+        image_data, digest, etag = download_image(image_url, etag)
+        if image_data is None:
+            return
+        # Group changed folders per variant so girls/boys copies share one stamp + encode
+        changed = {}
+        for price, size_option, folder_name, variant_id in targets:
+            key = r2_key(size_option, folder_name, variant_id)
+            if is_image_new(key, digest, price):
+                changed.setdefault((price, size_option, variant_id), []).append(folder_name)
+        for (price, size_option, variant_id), folder_names in changed.items():
+            submit_upload(upload_pool, image_data, (image_url, etag, digest), price, size_option, folder_names, variant_id)
+            logger.info(f"✅ Updated image for variant {variant_id} ({', '.join(folder_names)})")
+    except Exception as e:
+        logger.warning(f"⚠️ Error syncing image {image_url}: {e}")
+
 def handle_variant_update(payload):
+    jobs = {}  # image_url -> [(price, size_option, folder_name, variant_id)]
+    stale_keys = []
     for product in payload.get("products", [payload]):
         if not product.get("published_at"):  # skip unpublished
             continue
@@ -120,6 +395,8 @@ def handle_variant_update(payload):
         product_tags = product.get("tags", "").lower()
         is_girls = "girls" in product_tags
         is_boys = "boys" in product_tags
+        folder_names = [name for name, tagged in (("girls", is_girls), ("boys", is_boys)) if tagged]
+        image_urls = {image["id"]: image["src"] for image in product.get("images", [])}
 
         for variant in product.get("variants", []):
             variant_id = variant.get("id")
@@ -127,43 +404,42 @@ def handle_variant_update(payload):
             inventory = variant.get("inventory_quantity", 0)
             price = variant.get("price", "0")
 
-            if inventory <= 0:
-                continue
-
-            option_values = [
+            size_option = size_from_options(
                 variant.get('option1', ''),
                 variant.get('option2', ''),
                 variant.get('option3', '')
-            ]
-            size_option = next((sanitize_directory_name(v) for v in option_values if size_pattern.search(v)), "default")
-
-            size_directory = os.path.join(os.getcwd(), size_option)
-            girls_directory = os.path.join(size_directory, "girls") if is_girls else None
-            boys_directory = os.path.join(size_directory, "boys") if is_boys else None
-            for folder in [girls_directory, boys_directory]:
-                if folder:
-                    create_directory(folder)
-
-            image_file_name = f"{variant_id}.jpg"
-            image_url = None
-            for image in product.get("images", []):
-                if image["id"] == image_id:
-                    image_url = image["src"]
-                    break
+            )
+
+            if inventory <= 0:
+                stale_keys.extend(r2_key(size_option, folder_name, variant_id) for folder_name in folder_names)
+                continue
+
+            image_url = image_urls.get(image_id)
 
             if image_url:
-                for folder in filter(None, [girls_directory, boys_directory]):
-                    image_path = os.path.join(folder, image_file_name)
-                    changed = download_image_if_new(image_url, image_path)
-                    if changed:
-                        folder_name = "girls" if folder.endswith("girls") else "boys"
-                        add_price_to_image(image_path, price, size_option, folder_name, variant_id)
-                        print(f"✅ Updated image for variant {variant_id} at {image_path}")
+                for folder_name in folder_names:
+                    jobs.setdefault(image_url, []).append((price, size_option, folder_name, variant_id))
+
+    # Downloads and R2 uploads run on separate pools so slow uploads don't stall new downloads
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as upload_pool:
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as download_pool:
+            futures = [download_pool.submit(sync_image, url, targets, upload_pool) for url, targets in jobs.items()]
+            for future in as_completed(futures):
+                future.result()
+
+    # Persist this run's uploads before touching R2 again, so a failed delete can't lose them
+    with hash_db_lock:
+        hash_db.commit()
+
+    if stale_keys:
+        delete_stale_images(stale_keys)
+        with hash_db_lock:
+            hash_db.commit()
 
 def process_all_available_variants():
-    print("📦 Fetching products from Shopify...")
+    logger.info("📦 Fetching products from Shopify...")
     all_products = fetch_all_products()
-    print(f"✅ {len(all_products)} products fetched")
+    logger.info(f"✅ {len(all_products)} products fetched")
     payload = {"products": all_products}
     handle_variant_update(payload)
 